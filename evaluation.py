@@ -6,6 +6,8 @@ import yfinance as yf
 import pandas as pd, numpy as np
 from datetime import datetime
 import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 import seaborn as sns
 
@@ -13,10 +15,51 @@ import seaborn as sns
 sns.set_theme(style='ticks', palette='husl', font_scale=1.2)
 
 
+def pct_change(values, periods):
+    """
+    Calculate the percentage change over the given number of periods along the first axis
+    of a numpy array. The first rows, which have no earlier value to compare to, are nan
+    """
+    change = np.empty_like(values)
+    change[:periods] = np.nan
+    change[periods:] = (values[periods:] / values[:-periods] - 1.0) * 100.0
+    return change
+
+
+def snap_to_week(dates):
+    """
+    Round dates to the nearest Monday, the day Yahoo uses to label weekly prices
+    """
+    # rounding is relative to the epoch, a Thursday, so shift by four days to land on Mondays
+    offset = pd.Timedelta(days=4)
+    return (pd.DatetimeIndex(dates) - offset).round('7D') + offset
+
+
+def prices_complete(adj_close, tickers):
+    """
+    Check that downloaded prices have data for every requested ticker. Yahoo still returns a
+    column for a ticker whose download failed, but the column is entirely nan
+    """
+    return (not adj_close.empty and set(tickers).issubset(adj_close.columns)
+            and not adj_close[tickers].isna().all().any())
+
+
+def merge_weekly(left, right, by=None):
+    """
+    Left merge weekly price data onto the rows with the same sell_date. Sell dates after the
+    last weekly price have no price yet, so they are matched to the latest price instead
+    """
+    keys = ['price_date'] + ([by] if by else [])
+    left = left.assign(price_date=left['sell_date'].clip(upper=right['sell_date'].max()))
+    right = right.rename(columns={'sell_date': 'price_date'})
+    return pd.merge(left, right, on=keys, how='left').drop(columns='price_date')
+
+
 class HedgeFund:
-    def __init__(self, name, directory, n_weeks=13):
+    def __init__(self, name, directory, n_weeks=13, cache_dir='cache'):
         self.name = name
         self.directory = directory
+        self.cache_dir = cache_dir
         self.quarters = 0
         self.n_weeks = n_weeks
         self.positions = pd.DataFrame()
@@ -38,37 +81,60 @@ class HedgeFund:
         # get all files in the directory that end with .csv
         filenames = [filename for filename in os.listdir(self.directory) if filename.endswith('.csv')]
         self.quarters = len(filenames) - 1
-
-        ls = []
-        for filename in filenames:
-            positions = pd.read_csv(os.path.join(self.directory, filename))
-            positions.insert(0, 'date', filename.split('_')[1].split('.')[0])
-            ls.append(positions)
+        paths = [os.path.join(self.directory, filename) for filename in filenames]
+
+        # the filings rarely change, so reuse the parsed positions until a CSV file is added or modified
+        cache_key = hashlib.md5(
+            f'{self.directory}_{sorted(filenames)}_{max(os.path.getmtime(path) for path in paths)}_{self.n_weeks}'.encode()
+        ).hexdigest()
+        cache_path = os.path.join(self.cache_dir, f'positions_{cache_key}.parquet')
+        if os.path.exists(cache_path):
+            self.positions = pd.read_parquet(cache_path)
+            return
+
+        # parse the comma separated share counts and values as floats while reading
+        ls = [pd.read_csv(path, thousands=',', dtype={'Shares': 'float64', 'Value ($000)': 'float64'})
+              for path in paths]
+        # parse the filing date once per file, then repeat it for every row of that file
+        dates = pd.to_datetime([filename.split('_')[1].split('.')[0] for filename in filenames]).repeat(
+            [len(df) for df in ls])
 
         positions = pd.concat(ls, axis=0, ignore_index=True).rename(columns={'Sym': 'ticker', 'Cl': 'class'})
+        positions.insert(0, 'date', dates)
         # convert all columns to lowercase
         positions.columns = positions.columns.str.lower()
-        positions = positions.dropna(subset='ticker').sort_values(['date', 'ticker'])
+        positions = positions.dropna(subset='ticker')
+        # tickers repeat every quarter, so store them as categories to speed up the groupbys and merges
+        positions['ticker'] = positions['ticker'].astype('category')
         # drop rows where Cl contains an expiration date
-        positions = positions[~positions['class'].str.contains('EXP|UNIT', regex=True, case=False)]
-        positions['date'] = pd.to_datetime(positions['date'])
-        # the potential sell date is 13 weeks after the buy date
-        positions['sell_date'] = positions['date'] + pd.DateOffset(weeks=self.n_weeks)
+        class_upper = positions['class'].str.upper()
+        positions = positions[~(class_upper.str.contains('EXP', regex=False, na=False) |
+                                class_upper.str.contains('UNIT', regex=False, na=False))]
+        # the potential sell date is 13 weeks after the buy date, on the same weekly grid as the price data
+        positions['sell_date'] = snap_to_week(positions['date'] + pd.Timedelta(weeks=self.n_weeks))
+        # sort once on sell_date and keep each ticker in date order
+        positions = positions.sort_values(['sell_date', 'ticker'], ignore_index=True)
 
         # determine the change in the number of shares held by Deerfield Management over time
-        positions['shares'] = positions['shares'].str.replace(',', '').astype(float)
-        positions['change'] = positions.groupby('ticker')['shares'].diff()
+        prev = positions.groupby('ticker', observed=True)['shares'].shift(1)
         # if there was no previous position, assume the change is the same as the current position
-        positions['change'] = positions['change'].fillna(positions['shares'])
+        change = np.where(prev.isna(), positions['shares'], positions['shares'] - prev)
         # change must still be nan if the rows are from the earliest date
-        positions.loc[positions['date'] == positions['date'].min(), 'change'] = np.nan
+        date_values = positions['date'].values
+        change[date_values == date_values.min()] = np.nan
+        positions['change'] = change
         
-        positions['value'] = positions['value ($000)'].str.replace(',', '').astype(float) * 1000
+        positions['value'] = positions['value ($000)'] * 1000
 
-        # indicate the quarter for each row
-        positions['quarter'] = 'q' + positions['date'].dt.quarter.astype(str) + '_' + positions['date'].dt.year.astype(str)
+        # indicate the quarter for each row. the categories are built once per quarter in chronological order
+        codes, quarters = pd.factorize(positions['date'].dt.year * 10 + positions['date'].dt.quarter, sort=True)
+        positions['quarter'] = pd.Categorical.from_codes(
+            codes, [f'q{quarter % 10}_{quarter // 10}' for quarter in quarters])
         self.positions = positions
 
+        os.makedirs(self.cache_dir, exist_ok=True)
+        positions.to_parquet(cache_path)
+
 
     def get_prices(self):
         """
@@ -80,25 +146,61 @@ class HedgeFund:
         # --> need to remove these false positives
 
         # cannot determine share changes from the earliest date. Use the next date instead
-        start = self.positions['date'].unique()[1].astype(str)[:10]
-        end = self.positions['sell_date'].max().strftime('%Y-%m-%d')
-        price = yf.download(buy_tickers, start=start, end=end, interval='1wk')['Adj Close']
+        start = pd.Timestamp(self.positions['date'].unique()[1]).strftime('%Y-%m-%d')
+        # the end date is exclusive, so go one day past the last sell date to include its weekly price
+        end = (self.positions['sell_date'].max() + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+        tickers = sorted(set(buy_tickers) | {'VOO'})
+        interval = '1wk'
+
+        # historical weekly prices do not change, so reuse a previous download of the same tickers and range
+        cache_key = hashlib.md5(f'{tickers}_{interval}'.encode()).hexdigest()
+        cache_path = os.path.join(self.cache_dir, f'{self.name}_{start}_{end}_{cache_key}.parquet')
+        # the latest week is still changing until it has closed, so only cache ranges that are complete
+        cacheable = pd.Timestamp(end) + pd.Timedelta(weeks=1) <= pd.Timestamp.today().normalize()
+        adj_close = None
+        if cacheable and os.path.exists(cache_path):
+            adj_close = pd.read_parquet(cache_path)
+            # download again if the cached prices are missing any of the requested tickers
+            if not prices_complete(adj_close, tickers):
+                adj_close = None
+        if adj_close is None:
+            # download the positions and VOO in a single threaded batch rather than two round trips
+            adj_close = yf.download(tickers, start=start, end=end, interval=interval,
+                                    threads=True, group_by='column', auto_adjust=False)['Adj Close']
+            # do not cache a failed download, e.g. from a rate limit, so the next run tries again
+            if cacheable and prices_complete(adj_close, tickers) and not yf.shared._ERRORS:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                adj_close.to_parquet(cache_path)
+        # keep the prices as float32 to halve the memory of the price and merge frames
+        adj_close = adj_close.astype('float32')
+        # a partial final week can be labelled with its last trading day, so snap it and keep the latest row
+        adj_close.index = snap_to_week(adj_close.index)
+        adj_close = adj_close[~adj_close.index.duplicated(keep='last')]
+        price = adj_close[buy_tickers]
+        sp500 = adj_close['VOO']
         self.price = price
 
-        # calculate the percentage change in price over the past n_weeks
-        price_change = price.pct_change(self.n_weeks) * 100
-        # melt the price data to make it easier to merge with the positions data
-        price_change = price_change.reset_index().melt(
-            id_vars='Date', var_name='ticker', value_name='price_change').rename(columns={'Date': 'sell_date'})
-        price_change['sell_date'] = pd.to_datetime(price_change['sell_date'])
-        price_change.sort_values(['sell_date', 'ticker'], inplace=True)
+        # calculate the percentage change in price over the past n_weeks. missing weekly prices,
+        # e.g. from halted or delisted stocks, carry the last known price forward
+        price = price.ffill()
+        sp500 = sp500.ffill()
+        price_change = pd.DataFrame(pct_change(price.to_numpy(), self.n_weeks),
+                                    index=price.index, columns=price.columns)
+        # reshape the price data to long form to make it easier to merge with the positions data.
+        # built straight from the underlying array, keeping the rows where the change is nan
+        n_dates, n_tickers = price_change.shape
+        price_change = pd.DataFrame({
+            'sell_date': np.repeat(price_change.index.values, n_tickers),
+            'ticker': np.tile(price_change.columns.values, n_dates),
+            'price_change': price_change.to_numpy().ravel(),
+        })
+        # share the ticker categories of the positions so merges can match on the category codes
+        price_change['ticker'] = price_change['ticker'].astype(self.positions['ticker'].dtype)
         self.price_change = price_change
 
-        # get data for VOO
-        sp500 = yf.download('VOO', start=start, end=end, interval='1wk')['Adj Close']
-        sp500_change = sp500.pct_change(self.n_weeks) * 100
-        sp500_change = sp500_change.reset_index().rename(columns={'Adj Close': 'VOO', 'Date': 'sell_date'})
-        sp500_change['sell_date'] = pd.to_datetime(sp500_change['sell_date'])
+        # calculate the percentage change for VOO
+        sp500_change = pd.Series(pct_change(sp500.to_numpy(), self.n_weeks), index=sp500.index, name='VOO')
+        sp500_change = sp500_change.rename_axis('sell_date').reset_index()
         self.sp500_change = sp500_change
 
 
@@ -110,19 +212,21 @@ class HedgeFund:
         For example, a strategy that only buys stocks that have increased in value over the past n weeks.
         It would be interesting to compare how different strategies perform over time.
         """
-        # merge the positions data with the price data. the inner merge will drop rows where the price data is missing
-        portfolio = pd.merge_asof(self.positions, self.price_change, on='sell_date', 
-                                  by='ticker', direction='nearest')
+        # merge the positions data with the price data. positions without price data get a nan price change
+        portfolio = merge_weekly(self.positions, self.price_change, by='ticker')
 
         # calculate the weight of each position as a proportion of the total value per quarter
-        portfolio['weight'] = portfolio.groupby('quarter')['value'].transform(lambda x: x / x.sum())
+        portfolio['weight'] = portfolio['value'] / portfolio.groupby('quarter', observed=True)['value'].transform('sum')
 
         # calculate performance as the weighted sum of the returns
-        portfolio['performance'] = portfolio['price_change'] * portfolio['weight']
+        portfolio['performance'] = portfolio['price_change'].astype('float64') * portfolio['weight']
 
+        # the quarter categories are in chronological order, so the sorted groups are already ordered by sell_date
         performance = portfolio.groupby(
-            ['quarter','sell_date'])['performance'].sum().reset_index().sort_values('sell_date').reset_index(drop=True)
+            ['quarter','sell_date'], observed=True, as_index=False, sort=True)['performance'].sum(min_count=1)
         performance.loc[0, 'performance'] = np.nan
+        # the categories are only needed for the groupbys, so report the quarter as plain strings
+        performance['quarter'] = performance['quarter'].astype(str)
 
         self.portfolios[approach] = portfolio
         self.performance[approach] = performance
@@ -139,15 +243,15 @@ class HedgeFund:
         
         if len(self.performance) > 1:
             # combine the performance of the different portfolios into one dataframe by merging on the sell_date
-            ls = [df.rename(columns={'performance':approach}).drop(columns='quarter').set_index('sell_date') 
-                  for approach, df in self.performance.items()]
-            performance = pd.concat(ls, axis=1).reset_index()
+            performance = pd.DataFrame({approach: df.set_index('sell_date')['performance']
+                                        for approach, df in self.performance.items()}).rename_axis('sell_date').reset_index()
         else:
             performance = list(self.performance.values())[0]
 
         # compare the performance to the S&P 500
-        comparison = pd.merge_asof(performance, self.sp500_change, 
-                                   on='sell_date', direction='nearest')
+        comparison = merge_weekly(performance, self.sp500_change)
+        # report the returns in float64 so they round to clean two decimal values
+        comparison = comparison.astype({column: 'float64' for column in comparison.select_dtypes('float32').columns})
         if 'performance' in comparison.columns:
             comparison['outperformance'] = comparison['performance'] - comparison['VOO']
         comparison = comparison.round(2).sort_values(by='sell_date')
@@ -175,26 +279,42 @@ class HedgeFund:
         growth = self.comparison.fillna(0)
         # identify the investment approaches used
         approaches = growth.columns[~growth.columns.isin(['quarter', 'sell_date','outperformance'])]
-        growth[approaches] = growth[approaches].div(100) + 1
-        growth[approaches] = growth[approaches].cumprod() * principal
+        # compound the returns in place on a single array rather than allocating a frame per step
+        values = growth[approaches].to_numpy(dtype='float64')
+        np.multiply(values, 0.01, out=values)
+        np.add(values, 1.0, out=values)
+        np.cumprod(values, axis=0, out=values)
+        np.multiply(values, principal, out=values)
+        growth[approaches] = values
         growth = growth.round(2)
 
-        growth.plot(x='sell_date', y=[approaches])
+        growth.plot(x='sell_date', y=list(approaches))
         plt.ylabel(f'Value of ${principal:,.0f} investment')
 
-    
+
+def evaluate_fund(fund):
+    """
+    Evaluate a hedge fund and return it, so the evaluated object can be sent back from a worker process
+    """
+    fund.evaluate()
+    return fund
+
+
 if __name__ == '__main__':
     # get the current working directory
     top_directory = os.getcwd()
 
-    # create a HedgeFund object for Deerfield Management
-    deerfield = HedgeFund('Deerfield', os.path.join(top_directory, 'deerfield'))
-    deerfield.evaluate()
-    deerfield.plot_growth()
-    plt.show()
-
-    # # create a HedgeFund object for Point72 Asset Management
-    # point72 = HedgeFund('Point72', os.path.join(top_directory, 'point72'))
-    # point72.evaluate()
-    # point72.plot_growth()
-    # plt.show()
\ No newline at end of file
+    funds = [
+        # create a HedgeFund object for Deerfield Management
+        HedgeFund('Deerfield', os.path.join(top_directory, 'deerfield')),
+        # # create a HedgeFund object for Point72 Asset Management
+        # HedgeFund('Point72', os.path.join(top_directory, 'point72')),
+    ]
+
+    # the funds are independent, so evaluate them in separate processes
+    with ProcessPoolExecutor(max_workers=len(funds)) as executor:
+        funds = list(executor.map(evaluate_fund, funds))
+
+    for fund in funds:
+        fund.plot_growth()
+        plt.show()